@@ -5,14 +5,29 @@ from langgraph.checkpoint.memory import InMemorySaver
 
 class WhatsappAgents:
 
-    def __init__(self, tools: dict, GOOGLE_API_KEY: str):
-        model = init_chat_model(
-            model="gemini-2.5-flash",
-            model_provider="google_genai",
-            api_key=GOOGLE_API_KEY
-        )
+    # Gemini clients keyed by (model, api_key) so repeated constructions
+    # share one client instead of rebuilding it per agent set.
+    _models = {}
+
+    @classmethod
+    def _get_model(cls, model_name: str, api_key: str):
+        key = (model_name, api_key)
+        if key not in cls._models:
+            cls._models[key] = init_chat_model(
+                model=model_name,
+                model_provider="google_genai",
+                api_key=api_key
+            )
+        return cls._models[key]
+
+    def __init__(self, tools: dict, GOOGLE_API_KEY: str,
+                 download_model: str = "gemini-2.5-flash",
+                 monitor_model: str = "gemini-2.5-flash",
+                 digest_model: str = "gemini-2.5-flash-lite"):
         download_prompt = '''You are a message download agent that should check for new messages in chats.
+        Use get_all_unread_messages to fetch the unread messages for every chat in a single call.
         You should store all unread messages you see in a local database for future reference.
+        Prefer saving all the messages for a chat in one call to save_messages_to_db rather than saving them one at a time.
 
         Do not mark messages as read in the chat application.
         '''
@@ -20,7 +35,7 @@ class WhatsappAgents:
         priority_monitor_prompt = '''You are a message priority monitor agent that should load the unread messages from the database and assess their priority.
 
         You should then prioritise the messages based on urgency and importance. To do this for each one you should consider the following criteria:
-        * Is the message from a close contact (someone that I message or reply to regularly)?
+        * Is the message from a close contact (someone that I message or reply to regularly)? Check this with the is_close_contact tool rather than judging it yourself.
         * Does the message contain time-sensitive information (e.g., event reminders, urgent requests) that needs to be addressed in the next 48 hours?
         * Does the message require an immediate response?
         * Was the message sent in reply to a previous message of mine, or mention me, and so will require a response?
@@ -31,7 +46,7 @@ class WhatsappAgents:
 
         If there are any high priority messages:
         * Send one message to self using the given tool to alert me of the message(s) and its priority. Don't include the content, just the fact that the message is high priority and a brief summary of why. Start this message with the following text: "**** Whatsapp priority alert ****. You can combine the reason for multiple high priority messages in one chat into a single alert if there are more than one.
-        * Mark all high priority messages as processed in the database.
+        * Mark all high priority messages as processed in the database in one call to mark_messages_as_processed.
         '''
 
         digest_prompt = '''You are a message digest agent that should generate a summary of low priority information collected today. Load messages from the database and generate a summary (not just a direct recounting of) of all low priority information and conversations collected today and send it to me as a message to self. Note that sometimes to understand a message you may need to reference previous messages in the chat or search within the chat for context - do not just summarise individual messages if they make no sense on their own.
@@ -40,35 +55,62 @@ class WhatsappAgents:
 
         If there are no messages then just do nothing. Clearly mark this as a processed from the Whatsapp monitor using the following text at the start of the message: "**** Whatsapp daily digest **** '''
 
-        self._download_agent = create_react_agent(
-            model=model,
-            tools=tools.values(),
-            prompt=download_prompt,
-            #checkpointer=checkpoint_saver
-        )
-
-        self._monitor_agent = create_react_agent(
-            model=model,
-            tools=tools.values(),
-            prompt=priority_monitor_prompt,
-            #checkpointer=checkpoint_saver
-        )
-
-        self._digest_agent = create_react_agent(
-            model=model,
-            tools=tools.values(),
-            prompt=digest_prompt,
-            #checkpointer=checkpoint_saver
-        )
+        # Keep the slower per-chat enumeration tools out of the download
+        # agent so it cannot pick an O(chats) tool-call path.
+        download_tools = [tool for name, tool in tools.items()
+                          if name != "get_unread_chats"]
+
+        # One checkpointer shared by all three agents so a retried invocation
+        # on the same thread_id resumes instead of replaying tool calls.
+        self._checkpointer = InMemorySaver()
+
+        # Cheapest adequate model per agent: summarisation (digest) runs on
+        # the lite variant, priority judgement keeps the full flash model.
+        self._download_model = self._get_model(download_model, GOOGLE_API_KEY)
+        self._monitor_model = self._get_model(monitor_model, GOOGLE_API_KEY)
+        self._digest_model = self._get_model(digest_model, GOOGLE_API_KEY)
+
+        self._tools = tools
+        self._download_tools = download_tools
+        self._download_prompt = download_prompt
+        self._priority_monitor_prompt = priority_monitor_prompt
+        self._digest_prompt = digest_prompt
+
+        # Graph compilation is deferred until an agent is first used, so runs
+        # that skip a stage never pay for compiling its agent.
+        self._download_agent = None
+        self._monitor_agent = None
+        self._digest_agent = None
 
     @property
     def download_agent(self):
+        if self._download_agent is None:
+            self._download_agent = create_react_agent(
+                model=self._download_model,
+                tools=self._download_tools,
+                prompt=self._download_prompt,
+                checkpointer=self._checkpointer
+            )
         return self._download_agent
 
     @property
     def monitor_agent(self):
+        if self._monitor_agent is None:
+            self._monitor_agent = create_react_agent(
+                model=self._monitor_model,
+                tools=self._tools.values(),
+                prompt=self._priority_monitor_prompt,
+                checkpointer=self._checkpointer
+            )
         return self._monitor_agent
 
     @property
     def digest_agent(self):
+        if self._digest_agent is None:
+            self._digest_agent = create_react_agent(
+                model=self._digest_model,
+                tools=self._tools.values(),
+                prompt=self._digest_prompt,
+                checkpointer=self._checkpointer
+            )
         return self._digest_agent
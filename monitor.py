@@ -1,3 +1,5 @@
+import asyncio
+import json
 import os
 import sys
 
@@ -7,16 +9,39 @@ from tools import Tools
 from agents import WhatsappAgents
 
 
-load_dotenv()
-
 db_file = "messages.db"
-
-GOOGLE_API_KEY = os.getenv("GOOGLE_API_KEY")
-print("Using Google API Key:", GOOGLE_API_KEY)
 api_url = "http://localhost:3000/api"
 
 
-if __name__ == "__main__":
+async def prioritise_messages(agents, messages, batch_size=20, max_concurrency=8):
+    '''Prioritises messages in batches, concurrently, bounded to respect Gemini rate limits.
+
+    Batching amortises the fixed prompt and tool-schema tokens over many
+    messages instead of paying them once per message.'''
+    semaphore = asyncio.Semaphore(max_concurrency)
+
+    async def prioritise(batch):
+        payload = json.dumps([{"id": m[0], "chat_name": m[1],
+                               "message": m[2], "timestamp": m[3]}
+                              for m in batch])
+        async with semaphore:
+            return await agents.monitor_agent.ainvoke({
+                "messages": [
+                    {"role": "user", "content": f"Prioritise the following messages: {payload}"}
+                ]
+            }, config={"recursion_limit": 50,
+                       "configurable": {"thread_id": f"prioritise-{batch[0][0]}"}})
+
+    batches = [messages[i:i + batch_size]
+               for i in range(0, len(messages), batch_size)]
+    return await asyncio.gather(*[prioritise(batch) for batch in batches],
+                                return_exceptions=True)
+
+
+async def main():
+
+    load_dotenv()
+    GOOGLE_API_KEY = os.getenv("GOOGLE_API_KEY")
 
     download = True
     prioritise = True
@@ -28,30 +53,33 @@ if __name__ == "__main__":
     agents = WhatsappAgents(tools=tools, GOOGLE_API_KEY=GOOGLE_API_KEY)
 
     if download:
-        response = agents.download_agent.invoke({
+        response = await agents.download_agent.ainvoke({
             "messages": [
                 {"role": "user", "content": "Check for new messages."}
             ]
-        }, config={"recursion_limit": 50})
+        }, config={"recursion_limit": 50,
+                   "configurable": {"thread_id": "download"}})
 
         print(response['messages'][-1].content)
 
     if prioritise:
         messages = tools['generate_unprocessed_messages']()
-        for msg in messages:
-            response = agents.monitor_agent.invoke({
-                "messages": [
-                    {"role": "user", "content": "Prioritise message {msg}."}
-                ]
-            }, config={"recursion_limit": 50})
-
-        print(response['messages'][-1].content)
+        responses = await prioritise_messages(agents, messages)
+        for response in responses:
+            if isinstance(response, Exception):
+                print("Prioritisation failed:", response)
+            else:
+                print(response['messages'][-1].content)
 
     if create_digest:
-        response = agents.digest_agent.invoke({
+        response = await agents.digest_agent.ainvoke({
             "messages": [
                 {"role": "user", "content": "Generate a digest of unprocessed messages in the database, summarise and send as a message to self."}
             ]
-        })
+        }, config={"configurable": {"thread_id": "digest"}})
 
         print(response['messages'][-1].content)
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
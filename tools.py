@@ -1,18 +1,65 @@
+import atexit
+import json
+import queue
 import requests
 import sqlite3
+import threading
+import time
 
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+
+_JSON_HEADERS = {"Content-Type": "application/json"}
+
 
 class Tools:
 
+    # Reusing the exact same SQL text lets SQLite serve the statement from
+    # its compiled-statement cache instead of re-parsing per call.
+    INSERT_SQL = ("INSERT OR IGNORE INTO messages (chat_id, chat_name, message, timestamp, processed) "
+                  "VALUES (?, ?, ?, ?, ?)")
+
     def __init__(self, api_url, db_file):
         self.api_url = api_url
         self.db_file = db_file
 
-        with sqlite3.connect(self.db_file) as conn:
-            cursor = conn.cursor()
-            cursor.execute('''CREATE TABLE IF NOT EXISTS messages
+        # Pooled session so repeated calls to the API reuse TCP connections
+        # instead of paying a handshake per request; transient gateway errors
+        # are retried with backoff rather than surfacing to the agent.
+        self._http = requests.Session()
+        adapter = HTTPAdapter(pool_connections=20, pool_maxsize=20,
+                              max_retries=Retry(total=3, backoff_factor=0.2,
+                                                status_forcelist=[502, 503, 504]))
+        self._http.mount("http://", adapter)
+        self._http.mount("https://", adapter)
+        self._http.headers.update({"Accept": "application/json"})
+        # (connect, read) split: fail fast on an unreachable API but allow
+        # slower reads for large message payloads.
+        self._http_timeout = (3.05, 30)
+
+        # Fixed endpoint URLs assembled once rather than per call.
+        self._user_info_url = f"{api_url}/user-info"
+        self._chats_url = f"{api_url}/chats"
+        self._unread_chats_url = f"{api_url}/unread-chats"
+        self._mark_all_read_url = f"{api_url}/chats/mark-all-as-read"
+        self._send_message_url = f"{api_url}/send-message"
+        self._send_to_self_url = f"{api_url}/send-message-to-self"
+
+        # One long-lived connection; WAL lets the digest read while inserts
+        # are in flight and avoids a journal setup + fsync per statement.
+        self._conn = sqlite3.connect(self.db_file, check_same_thread=False,
+                                     isolation_level=None, cached_statements=128)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute("PRAGMA temp_store=MEMORY")
+        self._conn.execute("PRAGMA cache_size=-65536")
+        self._conn.execute("PRAGMA mmap_size=268435456")
+        self._conn.execute("PRAGMA busy_timeout=5000")
+        self._conn.execute('''CREATE TABLE IF NOT EXISTS messages
                           (id INTEGER PRIMARY KEY AUTOINCREMENT,
                           chat_id TEXT,
                           chat_name TEXT,
@@ -20,75 +67,238 @@ class Tools:
                           timestamp TEXT,
                           priority INTEGER DEFAULT 0,
                           processed INTEGER DEFAULT 0)''')
-            conn.commit()
+        # Dedupe is enforced through a named unique index rather than a
+        # table constraint so databases created before the constraint
+        # existed pick it up too; legacy duplicates are cleared first so
+        # the index can build.
+        self._conn.execute('''DELETE FROM messages WHERE id NOT IN
+                          (SELECT MIN(id) FROM messages
+                           GROUP BY chat_id, timestamp, message)''')
+        self._conn.execute("CREATE UNIQUE INDEX IF NOT EXISTS idx_messages_unique "
+                           "ON messages(chat_id, timestamp, message)")
+        # Partial index keeps the unprocessed scan O(unprocessed) rather than
+        # O(total) as the table accumulates history.
+        self._conn.execute("CREATE INDEX IF NOT EXISTS idx_messages_unprocessed "
+                           "ON messages(timestamp) WHERE processed = 0")
+        self._conn.execute("DROP INDEX IF EXISTS idx_messages_chat")
+        self._conn.execute("CREATE INDEX IF NOT EXISTS idx_messages_chat_ts "
+                           "ON messages(chat_id, timestamp)")
+        # Full-text index over the local mirror so search is served without
+        # an HTTP round trip; triggers keep it in sync with messages.
+        self._conn.execute("CREATE VIRTUAL TABLE IF NOT EXISTS messages_fts "
+                           "USING fts5(chat_id, chat_name, message, "
+                           "content='messages', content_rowid='id')")
+        self._conn.execute('''CREATE TRIGGER IF NOT EXISTS messages_fts_insert
+                          AFTER INSERT ON messages BEGIN
+                          INSERT INTO messages_fts(rowid, chat_id, chat_name, message)
+                          VALUES (new.id, new.chat_id, new.chat_name, new.message);
+                          END''')
+        self._conn.execute('''CREATE TRIGGER IF NOT EXISTS messages_fts_delete
+                          AFTER DELETE ON messages BEGIN
+                          INSERT INTO messages_fts(messages_fts, rowid, chat_id, chat_name, message)
+                          VALUES ('delete', old.id, old.chat_id, old.chat_name, old.message);
+                          END''')
+        # Backfill from the content table so history written before the
+        # triggers existed is searchable too.
+        self._conn.execute("INSERT INTO messages_fts(messages_fts) VALUES('rebuild')")
+        self._insert_count = 0
+        # The connection is shared across the tool-executor threads the
+        # agents may spawn; serialise access through one lock.
+        self._lock = threading.Lock()
+        # Short-lived cache for the read-only API calls the agent tends to
+        # repeat within a single run.
+        self._cache = {}
+        self._cache_ttl = 30
+        self._close_contacts = None
+        self._close_contacts_expiry = 0
+        self._tools_cache = None
+        # Single-writer queue: callers enqueue rows and return immediately,
+        # while one daemon thread drains them in executemany batches.
+        self._write_queue = queue.Queue(maxsize=10000)
+        threading.Thread(target=self._writer_loop, daemon=True).start()
+        atexit.register(self.close)
+
+    def _writer_loop(self):
+        while True:
+            batch = [self._write_queue.get()]
+            deadline = time.monotonic() + 0.01
+            while len(batch) < 500 and time.monotonic() < deadline:
+                try:
+                    batch.append(self._write_queue.get_nowait())
+                except queue.Empty:
+                    break
+            try:
+                with self._lock:
+                    self._conn.execute("BEGIN IMMEDIATE")
+                    try:
+                        self._conn.executemany(self.INSERT_SQL, batch)
+                        self._conn.execute("COMMIT")
+                    except Exception:
+                        self._conn.execute("ROLLBACK")
+                        raise
+                    self._count_inserts(len(batch))
+            except Exception:
+                # One malformed row must not kill the writer thread or throw
+                # away the rest of the batch: retry row by row and drop only
+                # the rows that still fail.
+                for row in batch:
+                    try:
+                        with self._lock:
+                            self._conn.execute(self.INSERT_SQL, row)
+                            self._count_inserts(1)
+                    except Exception as exc:
+                        print("Dropping message row that failed to save:", exc)
+            finally:
+                for _ in batch:
+                    self._write_queue.task_done()
+
+    def flush(self):
+        '''Blocks until all queued message saves have reached the database.'''
+        self._write_queue.join()
+
+    def _cached(self, key, fetch):
+        now = time.monotonic()
+        hit = self._cache.get(key)
+        if hit is not None and hit[0] > now:
+            return hit[1]
+        value = fetch()
+        self._cache[key] = (now + self._cache_ttl, value)
+        return value
+
+    def _invalidate_cache(self, chat_id=None):
+        if chat_id is None:
+            self._cache.clear()
+        else:
+            for key in [k for k in self._cache if chat_id in k or len(k) == 1]:
+                del self._cache[key]
 
     def get_user_info(self):
         '''Fetches user information from the API.'''
-        response = requests.get(f"{self.api_url}/user-info")
-        response.raise_for_status()
-        return response.json()
+        def fetch():
+            response = self._http.get(self._user_info_url, timeout=self._http_timeout)
+            response.raise_for_status()
+            return response.json()
+        return self._cached(("get_user_info",), fetch)
 
     def get_chats(self):
         '''Fetches the list of all chats from the API.'''
-        response = requests.get(f"{self.api_url}/chats")
-        response.raise_for_status()
-        return response.json()
+        def fetch():
+            response = self._http.get(self._chats_url, timeout=self._http_timeout)
+            response.raise_for_status()
+            return response.json()
+        return self._cached(("get_chats",), fetch)
 
     def get_unread_chats(self):
         '''Fetches the list of unread chats from the API.'''
-        response = requests.get(f"{self.api_url}/unread-chats")
-        response.raise_for_status()
-        return response.json()
-
-    def get_unread_messages(self):
-        '''Fetches unread messages for a specific chat.'''
-        response = requests.get(f"{self.api_url}/chats/{chat_id}/unread-messages")
-        response.raise_for_status()
-        return response.json()
+        def fetch():
+            response = self._http.get(self._unread_chats_url, timeout=self._http_timeout)
+            response.raise_for_status()
+            return response.json()
+        return self._cached(("get_unread_chats",), fetch)
 
     def get_messages_from_chat(self, chat_id, limit=10):
         '''Fetches the latest messages from a specific chat.'''
-        response = requests.get(f"{self.api_url}/chats/{chat_id}/messages", params={"limit": limit})
-        response.raise_for_status()
-        return response.json()
+        def fetch():
+            response = self._http.get(f"{self.api_url}/chats/{chat_id}/messages", params={"limit": limit}, timeout=self._http_timeout)
+            response.raise_for_status()
+            return response.json()
+        return self._cached(("get_messages_from_chat", chat_id, limit), fetch)
 
     def get_unread_messages_from_chat(self, chat_id, limit=10):
         '''Fetches the latest unread messages from a specific chat.'''
-        response = requests.get(f"{self.api_url}/chats/{chat_id}/unread-messages", params={"limit": limit})
+        response = self._http.get(f"{self.api_url}/chats/{chat_id}/unread-messages", params={"limit": limit}, timeout=self._http_timeout)
         response.raise_for_status()
         return response.json()
 
+    def get_unread_messages_for_chats(self, chat_ids: list, limit=10):
+        '''Fetches the latest unread messages for several chats at once.
+        Arguments:
+        chat_ids -- A list of chat IDs to fetch unread messages for
+        limit -- The maximum number of messages to fetch per chat
+        '''
+        with ThreadPoolExecutor(max_workers=8) as pool:
+            results = pool.map(
+                lambda chat_id: self.get_unread_messages_from_chat(chat_id, limit),
+                chat_ids)
+        return dict(zip(chat_ids, results))
+
+    def get_all_unread_messages(self, limit=10):
+        '''Fetches the unread messages for every chat with unread messages in one call.
+        Returns a list of {chat_id, chat_name, messages} entries.
+        Arguments:
+        limit -- The maximum number of messages to fetch per chat
+        '''
+        chats = self.get_unread_chats().get("data", [])
+        chat_ids = [chat["id"] for chat in chats]
+        messages = self.get_unread_messages_for_chats(chat_ids, limit)
+        return [{"chat_id": chat["id"],
+                 "chat_name": chat["name"],
+                 "messages": messages[chat["id"]]}
+                for chat in chats]
+
     def mark_chat_as_read(self, chat_id):
         '''Marks a specific chat as read.'''
-        response = requests.post(f"{self.api_url}/chats/{chat_id}/mark-as-read")
+        response = self._http.post(f"{self.api_url}/chats/{chat_id}/mark-as-read", timeout=self._http_timeout)
         response.raise_for_status()
+        self._invalidate_cache(chat_id)
         return response.json()
 
-    def mark_all_chats_as_read(self, ):
+    def mark_all_chats_as_read(self):
         '''Marks all chats as read.'''
-        response = requests.post(f"{self.api_url}/chats/mark-all-as-read")
+        response = self._http.post(self._mark_all_read_url, timeout=self._http_timeout)
         response.raise_for_status()
+        self._invalidate_cache()
         return response.json()
 
     def send_message(self, chat_id, message):
         '''Sends a message to a specific chat.'''
-        payload = {"chat_id": chat_id, "message": message}
-        response = requests.post(f"{self.api_url}/send-message", json=payload)
+        body = json.dumps({"chat_id": chat_id, "message": message})
+        response = self._http.post(self._send_message_url, data=body,
+                                   headers=_JSON_HEADERS, timeout=self._http_timeout)
         response.raise_for_status()
+        self._invalidate_cache(chat_id)
         return response.json()
 
     def send_message_to_self(self, message):
         '''Sends a message to oneself.'''
-        payload = {"message": message}
-        response = requests.post(f"{self.api_url}/send-message-to-self", json=payload)
+        body = json.dumps({"message": message})
+        response = self._http.post(self._send_to_self_url, data=body,
+                                   headers=_JSON_HEADERS, timeout=self._http_timeout)
         response.raise_for_status()
         return response.json()
 
     def search_messages(self, query, limit=10):
-        '''Searches messages containing a specific query.'''
-        response = requests.get(f"{self.api_url}/search-messages", params={"query": query, "limit": limit})
-        response.raise_for_status()
-        return response.json()
+        '''Searches the locally stored messages for a specific query.'''
+        # Quote each term so FTS5 treats the query as plain words rather than
+        # match syntax; apostrophes and hyphens would otherwise raise.
+        terms = " ".join('"' + term.replace('"', '""') + '"'
+                         for term in query.split())
+        if not terms:
+            return []
+        self.flush()
+        with self._lock:
+            cursor = self._conn.execute(
+                "SELECT messages.chat_id, messages.chat_name, messages.message, messages.timestamp "
+                "FROM messages_fts JOIN messages ON messages.id = messages_fts.rowid "
+                "WHERE messages_fts MATCH ? ORDER BY rank LIMIT ?", (terms, limit))
+            rows = cursor.fetchall()
+        return [{"chat_id": chat_id, "chat_name": chat_name,
+                 "message": message, "timestamp": timestamp}
+                for chat_id, chat_name, message, timestamp in rows]
+
+    def is_close_contact(self, chat_id: str):
+        '''Checks whether a chat is a close contact, i.e. one I exchange messages with regularly.'''
+        now = time.monotonic()
+        if self._close_contacts is None or now > self._close_contacts_expiry:
+            # Approximated from conversation volume in the local mirror; the
+            # mirror only holds inbound messages so frequency stands in for
+            # the reply-regularly signal.
+            with self._lock:
+                cursor = self._conn.execute(
+                    "SELECT chat_id FROM messages GROUP BY chat_id HAVING COUNT(*) >= 10")
+                self._close_contacts = {row[0] for row in cursor.fetchall()}
+            self._close_contacts_expiry = now + 300
+        return chat_id in self._close_contacts
 
     def save_message_to_db(self, chat_id: str, chat_name: str,
                            message: str, timestamp: str = None, processed: int = 0):
@@ -102,82 +312,152 @@ class Tools:
         if timestamp is None:
             timestamp = datetime.now().isoformat()
 
-        with sqlite3.connect(self.db_file) as conn:
-            cursor = conn.cursor()
-            cursor.execute("INSERT INTO messages (chat_id, chat_name, message, timestamp, processed) "
-                           "VALUES (?, ?, ?, ?, ?)", (chat_id, chat_name, message, timestamp, processed)
-                           )
-            conn.commit()
+        self._write_queue.put((chat_id, chat_name, message, timestamp, processed))
+
+    def save_messages_to_db(self, messages: list):
+        '''Saves a batch of messages to the local SQLite database in one transaction.
+        Arguments:
+        messages -- A list of dicts, each with keys chat_id, chat_name, message
+                    and optionally timestamp and processed
+        '''
+        # Full-precision per-row timestamps: the UNIQUE(chat_id, timestamp,
+        # message) dedupe key must not collapse distinct messages that happen
+        # to share text and arrive close together.
+        rows = [(m["chat_id"], m["chat_name"], m["message"],
+                 m.get("timestamp") or datetime.now().isoformat(),
+                 m.get("processed", 0))
+                for m in messages]
+        # The connection runs in autocommit (isolation_level=None), so the
+        # transaction has to be explicit for the batch to commit as one.
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                self._conn.executemany(self.INSERT_SQL, rows)
+                self._conn.execute("COMMIT")
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                raise
+            self._count_inserts(len(rows))
+
+    def _count_inserts(self, n):
+        # Refresh planner statistics every so often so the partial index keeps
+        # being chosen as the table grows.
+        self._insert_count += n
+        if self._insert_count >= 500:
+            self._conn.execute("ANALYZE messages")
+            self._insert_count = 0
+
+    def close(self):
+        '''Closes the HTTP session and the SQLite connection, letting the planner update its stats.'''
+        self._http.close()
+        self.flush()
+        try:
+            with self._lock:
+                self._conn.execute("PRAGMA optimize")
+                self._conn.close()
+        except sqlite3.ProgrammingError:
+            pass  # already closed
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
 
     def prioritise_message(self, message_id: int, priority: int):
         '''Sets the priority of a message in the local SQLite database.'''
-        with sqlite3.connect(self.db_file) as conn:
-            cursor = conn.cursor()
-            cursor.execute("UPDATE messages SET priority = ? WHERE id = ?", (priority, message_id))
-            conn.commit()
+        with self._lock:
+            self._conn.execute("UPDATE messages SET priority = ? WHERE id = ?", (priority, message_id))
 
     def mark_message_as_processed(self, message_id: int):
         '''Marks a message as processed in the local SQLite database.'''
-        with sqlite3.connect(self.db_file) as conn:
-            cursor = conn.cursor()
-            cursor.execute("UPDATE messages SET processed = 1 WHERE id = ?", (message_id,))
-            conn.commit()
+        with self._lock:
+            self._conn.execute("UPDATE messages SET processed = 1 WHERE id = ?", (message_id,))
+
+    def mark_messages_as_processed(self, message_ids: list):
+        '''Marks a batch of messages as processed in the local SQLite database.
+        Arguments:
+        message_ids -- A list of message IDs to mark as processed
+        '''
+        if not message_ids:
+            return
+        placeholders = ",".join("?" * len(message_ids))
+        with self._lock:
+            self._conn.execute(
+                f"UPDATE messages SET processed = 1 WHERE id IN ({placeholders})",
+                tuple(message_ids))
 
     def generate_unprocessed_messages(self):
         '''Generates a list of id, chat_name, message, timestamp for unprocessed messages from the local SQLite database.'''
-        with sqlite3.connect(self.db_file) as conn:
-            cursor = conn.cursor()
-            cursor.execute("SELECT id, chat_name, message, timestamp FROM messages WHERE processed = 0")
-            rows = cursor.fetchall()
-            # Mark messages as processed
-            cursor.execute("UPDATE messages SET processed = 1 WHERE processed = 0")
-            conn.commit()
-
-        return rows
+        # RETURNING (SQLite >= 3.35) marks and returns the rows in one
+        # statement, so a message inserted mid-call can never be flipped to
+        # processed without also being returned.
+        self.flush()
+        with self._lock:
+            cursor = self._conn.execute(
+                "UPDATE messages SET processed = 1 WHERE processed = 0 "
+                "RETURNING id, chat_name, message, timestamp")
+            return cursor.fetchall()
 
     def tools(self):
+        if self._tools_cache is None:
+            self._tools_cache = self._build_tools()
+        return self._tools_cache
+
+    def _build_tools(self):
         return {
             "get_user_info": self.get_user_info,
             "get_chats": self.get_chats,
             "get_unread_chats": self.get_unread_chats,
-            "get_unread_messages": self.get_unread_messages,
             "get_messages_from_chat": self.get_messages_from_chat,
             "get_unread_messages_from_chat": self.get_unread_messages_from_chat,
+            "get_unread_messages_for_chats": self.get_unread_messages_for_chats,
+            "get_all_unread_messages": self.get_all_unread_messages,
             "mark_chat_as_read": self.mark_chat_as_read,
             "mark_all_chats_as_read": self.mark_all_chats_as_read,
             "send_message_to_self": self.send_message_to_self,
             "search_messages": self.search_messages,
+            "is_close_contact": self.is_close_contact,
             "save_message_to_db": self.save_message_to_db,
+            "save_messages_to_db": self.save_messages_to_db,
             "prioritise_message": self.prioritise_message,
             "mark_message_as_processed": self.mark_message_as_processed,
+            "mark_messages_as_processed": self.mark_messages_as_processed,
             "generate_unprocessed_messages": self.generate_unprocessed_messages
         }
 
 
 
+# Test data based on format from server.js, built once at module scope so
+# repeated calls don't reconstruct the nested dicts.
+_USER_INFO_FIXTURE = {
+    "success": True,
+    "data": {
+        "name": "Test User",
+        "number": "+1234567890",
+        "wid": 100,
+        "platform": "web"
+    }
+}
+
+_CHAT_FIXTURE = {
+    "id": "chat1",
+    "name": "Test Chat",
+    "isGroup": False,
+    "unreadCount": 2,
+    "isReadOnly": False
+}
+
+
 class TestTools(Tools):
 
-    def __init__(self, api_url, db_file):
-        pass
+    def __init__(self, api_url, db_file=":memory:"):
+        # An in-memory database keeps the DB methods working under test
+        # without touching the real message mirror.
+        super().__init__(api_url, ":memory:")
 
     def get_user_info(self):
-        return json.loads({
-            "success": true,
-            "data": {
-                "name": "Test User",
-                "number": "+1234567890",
-                "wid": 100,
-                "platform": "web"
-            }
-        })
-
-    # Generate test data based on format from server.js
+        return _USER_INFO_FIXTURE
 
     def get_chats(self):
-        return json.loads({
-            "id": "chat1",
-            "name": "Test Chat",
-            "isGroup": false,
-            "unreadCount": 2,
-            "isReadOnly": false
-        })
+        return _CHAT_FIXTURE